@@ -1,22 +1,180 @@
-from flask import Flask, Response, jsonify
+from flask import Flask, Response, jsonify, request
+import hashlib
 import cv2
+import numpy as np
+import requests
 import threading
 import time
-from collections import deque
 import os
+import re
 
 app = Flask(__name__)
 
 # Config
 CAMERA_ID = "http://192.168.1.72:8080/video"  # << Use your MJPEG stream here!
-frame_buffer = deque(maxlen=30)
-buffer_fill = 0
-camera_lock = threading.Lock()
+STREAM_SIZE = None  # e.g. (1280, 720) to re-encode; None passes source JPEGs through
+RING_SIZE = 32  # Must be a power of two
+PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+
+
+class SPSCRing:
+    """Lock-free ring of recent JPEG frames with one producer
+
+    Only the capture thread writes. A frame is stored in its slot before
+    head is advanced, and each store is a single atomic assignment under the
+    GIL, so readers that see the new head also see the frame.
+    """
+    __slots__ = ('buf', 'head', 'mask')
+
+    def __init__(self, size):
+        self.buf = [None] * size
+        self.head = 0
+        self.mask = size - 1
+
+    def push(self, item):
+        self.buf[self.head & self.mask] = item
+        self.head += 1
+
+    def latest(self):
+        head = self.head
+        if head == 0:
+            return None
+        return self.buf[(head - 1) & self.mask]
+
+    def __len__(self):
+        return min(self.head, self.mask + 1)
+
+
+frame_buffer = SPSCRing(RING_SIZE)
+frame_ready = threading.Condition()
+# (buffer_fill, connected), rebound as a whole by the capture thread so
+# readers always see a consistent pair without locking
+status_snapshot = (0, False)
+
+def encode_jpeg(frame):
+    """Encode a frame for /video, resized to STREAM_SIZE if one is set"""
+    if STREAM_SIZE and (frame.shape[1], frame.shape[0]) != STREAM_SIZE:
+        frame = cv2.resize(frame, STREAM_SIZE)
+    success, buffer = cv2.imencode('.jpg', frame)
+    return buffer.tobytes() if success else None
+
+def publish_frame(jpeg):
+    """Make a JPEG the latest frame and wake the stream generators"""
+    global status_snapshot
+    frame_buffer.push(jpeg)
+    status_snapshot = (min(100, (len(frame_buffer) / RING_SIZE) * 100), True)
+    with frame_ready:
+        frame_ready.notify_all()
+
+def read_mjpeg(response, chunk_size=64 * 1024):
+    """Yield the JPEG parts of a streaming multipart/x-mixed-replace response
+
+    The boundary comes from the Content-Type header, or from the first
+    boundary line in the body when the header lacks it. A part with a
+    Content-Length is sliced out directly; otherwise the body runs to the
+    next delimiter, found with bytes.find (CPython's fastsearch, which skips
+    ahead Boyer-Moore-Horspool style instead of testing every byte).
+    """
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buf = bytearray()
+
+    def read_more():
+        chunk = next(chunks, None)
+        if chunk:
+            buf.extend(chunk)
+        return chunk is not None
+
+    match = re.search(r'boundary="?([^";]+)"?', response.headers.get('Content-Type', ''))
+    if match:
+        boundary = match.group(1).encode()
+    else:
+        while b'\r\n' not in buf.lstrip():
+            if not read_more():
+                return
+        line = buf.lstrip().split(b'\r\n', 1)[0].rstrip()
+        boundary = line[2:] if line.startswith(b'--') else line
+
+    # Every delimiter is CRLF "--" boundary, bar the one opening the stream;
+    # giving that one a CRLF too means a bare boundary token inside a JPEG
+    # can never end a part
+    delimiter = b'\r\n--' + boundary
+    buf[:0] = b'\r\n'
+
+    while True:
+        # Find the next part header
+        start = buf.find(delimiter)
+        header_end = buf.find(b'\r\n\r\n', start + len(delimiter)) if start >= 0 else -1
+        if header_end < 0:
+            if not read_more():
+                return
+            continue
+        body_start = header_end + 4
+
+        length = re.search(rb'(?i)content-length:\s*(\d+)', buf[start:header_end])
+        if length:
+            # Fast path: the server told us how big the JPEG is
+            body_end = body_start + int(length.group(1))
+            while len(buf) < body_end:
+                if not read_more():
+                    return
+            frame = bytes(buf[body_start:body_end])
+            del buf[:body_end]
+        else:
+            # Scan for the delimiter that ends this part
+            search_from = body_start
+            next_start = buf.find(delimiter, search_from)
+            while next_start < 0:
+                search_from = max(body_start, len(buf) - len(delimiter) + 1)
+                if not read_more():
+                    return
+                next_start = buf.find(delimiter, search_from)
+            frame = bytes(buf[body_start:next_start])
+            del buf[:next_start]
+
+        yield frame
 
 def capture_thread():
     """Capture frames from camera or network stream"""
-    global buffer_fill
-    cap = cv2.VideoCapture(CAMERA_ID)
+    if isinstance(CAMERA_ID, str) and CAMERA_ID.startswith(('http://', 'https://')):
+        capture_mjpeg_stream()
+    else:
+        capture_device()
+
+def capture_mjpeg_stream():
+    """Relay JPEGs from an HTTP MJPEG source, reconnecting on errors
+
+    Source JPEGs are published untouched; they are only decoded and
+    re-encoded when STREAM_SIZE asks for a different resolution.
+    """
+    while True:
+        try:
+            response = requests.get(CAMERA_ID, stream=True, timeout=10)
+            response.raise_for_status()
+            print("✅ Camera or stream opened")
+            for jpeg in read_mjpeg(response):
+                if STREAM_SIZE:
+                    frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if frame is None:
+                        continue
+                    jpeg = encode_jpeg(frame)
+                if jpeg:
+                    publish_frame(jpeg)
+            print("❌ Stream ended, reconnecting...")
+        except requests.RequestException as e:
+            print(f"❌ Camera or stream not found! ({e})")
+        time.sleep(1)
+
+def capture_device():
+    """Capture frames through OpenCV (local cameras, RTSP, files)"""
+    # Force the FFmpeg backend for URLs and files and let it decode on
+    # VA-API/NVDEC/etc. when available; it falls back to software decode
+    # otherwise. Hardware acceleration can only be requested at open time.
+    if isinstance(CAMERA_ID, str):
+        cap = cv2.VideoCapture(CAMERA_ID, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY
+        ])
+    else:
+        cap = cv2.VideoCapture(CAMERA_ID)
     
     if not cap.isOpened():
         print("❌ Camera or stream not found!")
@@ -27,38 +185,48 @@ def capture_thread():
     while True:
         ret, frame = cap.read()
         if ret:
-            with camera_lock:
-                frame_buffer.append(frame)
-                buffer_fill = min(100, (len(frame_buffer) / 30.0) * 100)
+            # Encode once here rather than once per connected client
+            jpeg = encode_jpeg(frame)
+            if jpeg:
+                publish_frame(jpeg)
         time.sleep(0.033)
 
+# Process the capture thread was started in; a worker forked after import
+# (gunicorn --preload) has none running and starts its own
+capture_pid = None
+capture_lock = threading.Lock()
+
+def start_capture():
+    """Start the capture thread once per process"""
+    global capture_pid
+    if capture_pid == os.getpid():
+        return  # Checked on every request, so skip the lock when running
+    with capture_lock:
+        if capture_pid == os.getpid():
+            return
+        capture_pid = os.getpid()
+    print("🎥 Starting camera or stream capture...")
+    threading.Thread(target=capture_thread, daemon=True).start()
+
 def stream_generator():
     """Generate MJPEG stream"""
+    last_head = 0
     while True:
-        with camera_lock:
-            if len(frame_buffer) == 0:
-                time.sleep(0.1)
+        # Sleep until the capture thread publishes a frame we haven't sent
+        with frame_ready:
+            if not frame_ready.wait_for(lambda: frame_buffer.head != last_head, timeout=1.0):
                 continue
-            frame = frame_buffer[-1].copy()
-        
-        # Resize
-        frame = cv2.resize(frame, (1280, 720))
-        
-        # Encode
-        success, buffer = cv2.imencode('.jpg', frame)
-        if not success:
-            continue
+        last_head = frame_buffer.head
+        frame_data = frame_buffer.latest()
         
-        frame_data = buffer.tobytes()
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n'
-               b'Content-Length: ' + str(len(frame_data)).encode() + b'\r\n\r\n' +
-               frame_data + b'\r\n')
+        # Send the part header, JPEG and trailer as separate chunks so the
+        # JPEG bytes reach the socket without being copied into a new buffer
+        yield PART_HEADER % len(frame_data)
+        yield frame_data
+        yield b'\r\n'
 
-@app.route('/')
-def index():
-    return """
+# Static page, encoded once instead of on every request
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <body style="text-align: center; font-family: Arial; background: #f5f5f5; margin: 0; padding: 20px;">
@@ -77,24 +245,41 @@ def index():
         </div>
     </body>
     </html>
-    """
+    """.encode('utf-8')
+INDEX_ETAG = hashlib.sha256(INDEX_HTML).hexdigest()
+
+# gunicorn imports app:app and never runs __main__, so capture starts here
+start_capture()
+
+@app.before_request
+def ensure_capture():
+    start_capture()
+
+@app.route('/')
+def index():
+    response = Response(INDEX_HTML, mimetype='text/html',
+                        headers={'Cache-Control': 'public, max-age=300'})
+    response.set_etag(INDEX_ETAG)
+    # Reconnecting viewers revalidate with If-None-Match and get a bodiless 304
+    return response.make_conditional(request)
 
 @app.route('/video')
 def video():
-    return Response(stream_generator(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # Proxies must pass each part on as it arrives, not buffer the stream
+    return Response(stream_generator(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store, no-transform',
+                             'X-Accel-Buffering': 'no'},
+                    direct_passthrough=True)
 
 @app.route('/api/status')
 def api_status():
+    buffer_fill, connected = status_snapshot
     return jsonify({
         'buffer': buffer_fill,
-        'connected': len(frame_buffer) > 0
+        'connected': connected
     })
 
 if __name__ == '__main__':
-    print("🎥 Starting camera or stream capture...")
-    t = threading.Thread(target=capture_thread, daemon=True)
-    t.start()
-
     port = int(os.environ.get('PORT', 8080))  # <-- port from Railway or 8080 by default
     print(f"🌐 Open: http://localhost:{port}")
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -1,54 +1,105 @@
 import os
+import re
+import json
+from functools import lru_cache
 import cv2
-from flask import Flask, jsonify, Response
-from flask_cors import CORS
+from flask import Flask, Response, request
 
 app = Flask(__name__)
-CORS(app, origins=[
+
+# CORS: exact origins are a set lookup, wildcard hosts are anchored regexes
+CORS_ORIGINS = frozenset({
     "https://kadelj61-oss.github.io",
-    "https://*.up.railway.app",
     "https://direction-may-banners-december.trycloudflare.com"
-])
+})
+CORS_ORIGIN_PATTERNS = (
+    re.compile(r"https://[a-z0-9-]+\.up\.railway\.app"),
+)
+
+@lru_cache(maxsize=256)
+def origin_allowed(origin):
+    """Check an Origin header; viewers come from few origins, so results are cached"""
+    return origin in CORS_ORIGINS or any(p.fullmatch(origin) for p in CORS_ORIGIN_PATTERNS)
+
+@app.after_request
+def add_cors_headers(response):
+    response.vary.add('Origin')
+    origin = request.headers.get('Origin')
+    if origin and origin_allowed(origin):
+        response.headers['Access-Control-Allow-Origin'] = origin
+        if request.method == 'OPTIONS':
+            response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD, POST, OPTIONS'
+            requested_headers = request.headers.get('Access-Control-Request-Headers')
+            if requested_headers:
+                response.headers['Access-Control-Allow-Headers'] = requested_headers
+            # Let browsers reuse the preflight for a day
+            response.headers['Access-Control-Max-Age'] = '86400'
+    return response
 
 @app.route('/')
 def home():
     return 'Flask server is running!', 200
 
+# Constant payloads, serialized once. A fresh Response is still built per
+# request since the CORS after_request hook adds headers to it.
+HEALTH_BODY = json.dumps({"status": "OK"}).encode('utf-8')
+STATS_BODY = json.dumps({
+    "status": "online",
+    "resolution": "1920x1080",
+    "fps": 30,
+    "bitrate": "3Mbps",
+    "viewers": 1
+}).encode('utf-8')
+
 @app.route('/health')
 def health():
-    from flask import jsonify
-    return jsonify({"status": "OK"})
+    return Response(HEALTH_BODY, mimetype='application/json')
 
 @app.route('/api/stats')
 def api_stats():
-    return jsonify({
-        "status": "online",
-        "resolution": "1920x1080",
-        "fps": 30,
-        "bitrate": "3Mbps",
-        "viewers": 1
-    })
+    return Response(STATS_BODY, mimetype='application/json')
 
 def gen_frames():
-    cap = cv2.VideoCapture(0)
+    # Ask the camera for MJPG and skip OpenCV's decode, so read() hands back
+    # the compressed frame and it can be sent as-is
+    cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+    if not cap.isOpened():
+        cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("Camera could not be opened!")
         return
+    mjpg = cv2.VideoWriter_fourcc(*'MJPG')
+    cap.set(cv2.CAP_PROP_FOURCC, mjpg)
+    # Without MJPG, unconverted frames are raw YUYV/NV12 that imencode can't use
+    if int(cap.get(cv2.CAP_PROP_FOURCC)) == mjpg:
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
     while True:
         success, frame = cap.read()
         if not success:
             break
         else:
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            # The undecoded JPEG comes back as a 1xN (or flat) byte array
+            if frame.ndim == 1 or frame.shape[0] == 1:
+                frame_bytes = frame.reshape(-1).tobytes()
+            else:
+                # Backend ignored CONVERT_RGB=0 and decoded the frame
+                ret, buffer = cv2.imencode('.jpg', frame)
+                if not ret:
+                    continue
+                frame_bytes = buffer.tobytes()
+            # One allocation sized for the whole part, instead of a copy of
+            # the JPEG for every '+'
+            yield b''.join((b'--frame\r\n'
+                             b'Content-Type: image/jpeg\r\n\r\n', frame_bytes, b'\r\n'))
     cap.release()
 
 @app.route('/stream')
 def stream():
     return Response(gen_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+                    mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store, no-transform',
+                             'X-Accel-Buffering': 'no'},
+                    direct_passthrough=True)
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 8080))
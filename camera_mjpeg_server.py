@@ -1,26 +1,40 @@
-from flask import Flask, Response
+from flask import Flask, Response, request
+import hashlib
 import cv2
 
 app = Flask(__name__)
 
 # Try 0 or 1 if you have multiple cameras; 0 is usually the built-in, 1 is often USB
 CAMERA_ID = 1
-cap = cv2.VideoCapture(CAMERA_ID)
+# With MJPG and no RGB conversion, gen_frames relays the camera's own JPEGs
+cap = cv2.VideoCapture(CAMERA_ID, cv2.CAP_V4L2)
+if not cap.isOpened():
+    cap = cv2.VideoCapture(CAMERA_ID)
+MJPG_FOURCC = cv2.VideoWriter_fourcc(*'MJPG')
+cap.set(cv2.CAP_PROP_FOURCC, MJPG_FOURCC)
+# Only safe if the camera took MJPG; otherwise read() must keep converting
+# the raw YUV frames to BGR
+if int(cap.get(cv2.CAP_PROP_FOURCC)) == MJPG_FOURCC:
+    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
 
 def gen_frames():
     while True:
         success, frame = cap.read()
         if not success:
             break
-        # Optionally resize: frame = cv2.resize(frame, (1280, 720))
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame_bytes = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        # A real picture is never one row high, so this is the raw MJPG buffer
+        if frame.ndim == 1 or frame.shape[0] == 1:
+            frame_bytes = frame.reshape(-1).tobytes()
+        else:
+            # Optionally resize: frame = cv2.resize(frame, (1280, 720))
+            ret, buffer = cv2.imencode('.jpg', frame)
+            if not ret:
+                continue
+            frame_bytes = buffer.tobytes()
+        yield b''.join((b'--frame\r\n'
+                         b'Content-Type: image/jpeg\r\n\r\n', frame_bytes, b'\r\n'))
 
-@app.route('/')
-def index():
-    return '''
+INDEX_HTML = '''
     <html>
     <head><title>USB Camera MJPEG Stream</title></head>
     <body>
@@ -28,11 +42,22 @@ def index():
     <img src="/video" width="640" />
     </body>
     </html>
-    '''
+    '''.encode('utf-8')
+INDEX_ETAG = hashlib.sha256(INDEX_HTML).hexdigest()
+
+@app.route('/')
+def index():
+    response = Response(INDEX_HTML, mimetype='text/html',
+                        headers={'Cache-Control': 'public, max-age=300'})
+    response.set_etag(INDEX_ETAG)
+    return response.make_conditional(request)
 
 @app.route('/video')
 def video():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store, no-transform',
+                             'X-Accel-Buffering': 'no'},
+                    direct_passthrough=True)
 
 if __name__ == '__main__':
     print("Camera server running! Open http://localhost:8080 in your browser.")
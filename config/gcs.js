@@ -1,5 +1,6 @@
-const { Storage } = require('@google-cloud/storage');
+const { Storage, TransferManager } = require('@google-cloud/storage');
 const path = require('path');
+const fs = require('fs');
 
 /**
  * Initialize and configure Google Cloud Storage client
@@ -42,57 +43,220 @@ function initializeGCS() {
   }
 }
 
+// Files at least this large go up as parallel chunks (XML multipart API)
+// instead of one sequential stream
+const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const CHUNK_CONCURRENCY = 8;
+// Chunked uploads allowed at once across the process; later ones wait, so
+// at most this many times CHUNK_CONCURRENCY parts (and chunk buffers) are
+// in flight however many large files arrive together
+const CHUNKED_UPLOADS_IN_FLIGHT = 2;
+
+/**
+ * Counting semaphore for async work
+ */
+class Semaphore {
+  constructor(permits) {
+    this.permits = permits;
+    this.waiting = [];
+  }
+
+  async acquire() {
+    if (this.permits > 0) {
+      this.permits--;
+      return;
+    }
+    await new Promise((resolve) => this.waiting.push(resolve));
+  }
+
+  release() {
+    const next = this.waiting.shift();
+    if (next) {
+      next(); // Hand the permit straight to the next waiter
+    } else {
+      this.permits++;
+    }
+  }
+}
+
+const chunkedUploadSlots = new Semaphore(CHUNKED_UPLOADS_IN_FLIGHT);
+
+// Lifetime of signed URLs handed out for buckets with per-object ACLs
+// (7 days is the maximum for V4 signatures)
+const SIGNED_URL_TTL_MS = 7 * 24 * 60 * 60 * 1000;
+
+// Whether each bucket uses uniform bucket-level access, looked up once
+const uniformAccessCache = new WeakMap();
+
+/**
+ * Check whether a bucket uses uniform bucket-level access
+ * @param {Object} bucket - GCS bucket instance
+ * @returns {Promise<boolean>} True if object ACLs are disabled; false if
+ *   the bucket's metadata can't be read, since a signed URL works either way
+ */
+function hasUniformAccess(bucket) {
+  if (!uniformAccessCache.has(bucket)) {
+    const lookup = bucket.getMetadata()
+      .then(([metadata]) =>
+        Boolean(metadata.iamConfiguration?.uniformBucketLevelAccess?.enabled)
+      )
+      .catch((error) => {
+        // roles/storage.objectAdmin lacks storage.buckets.get, and that
+        // won't change between uploads; retry anything else next time
+        if (error.code !== 403) {
+          uniformAccessCache.delete(bucket);
+        }
+        console.warn(`Could not read bucket metadata, using signed URLs: ${error.message}`);
+        return false;
+      });
+    uniformAccessCache.set(bucket, lookup);
+  }
+  return uniformAccessCache.get(bucket);
+}
+
 /**
  * Upload a file to Google Cloud Storage
  * @param {Object} bucket - GCS bucket instance
- * @param {Object} file - File object from multer
+ * @param {Object} file - File object from multer (disk or memory storage)
  * @param {string} destinationPath - Destination path in GCS
- * @returns {Promise<Object>} Upload result with public URL
+ * @param {number} [uploadedAtMs] - Upload time in ms since the epoch,
+ *   so callers can reuse the one they put in destinationPath
+ * @returns {Promise<Object>} Upload result with a public or signed URL
  */
-async function uploadToGCS(bucket, file, destinationPath) {
+async function uploadToGCS(bucket, file, destinationPath, uploadedAtMs = Date.now()) {
   try {
     const blob = bucket.file(destinationPath);
-    const blobStream = blob.createWriteStream({
-      resumable: false,
+    const uniformAccess = hasUniformAccess(bucket);
+    const uploadedAt = new Date(uploadedAtMs).toISOString();
+
+    if (file.path && file.size >= CHUNKED_UPLOAD_THRESHOLD) {
+      await uploadInChunks(bucket, file, destinationPath, uploadedAt);
+    } else {
+      await uploadAsStream(blob, file, uploadedAt);
+    }
+
+    // Read access comes from bucket IAM; there is no object ACL to set
+    const url = (await uniformAccess)
+      ? publicUrl(blob)
+      : await readableUrl(blob, uploadedAtMs);
+
+    return {
+      filename: blob.name,
+      url: url,
+      size: file.size,
+      mimetype: file.mimetype,
+      uploadedAt: uploadedAt
+    };
+  } catch (error) {
+    console.error('GCS upload failed:', error);
+    throw error;
+  }
+}
+
+/**
+ * Plain URL of an object
+ * @param {Object} blob - GCS file instance
+ * @returns {string} URL readable by anyone the bucket or object allows
+ */
+function publicUrl(blob) {
+  return `https://storage.googleapis.com/${blob.bucket.name}/${blob.name}`;
+}
+
+/**
+ * Get a URL for an object in a bucket with per-object ACLs
+ *
+ * The object is already written by the time this runs, so a failure here
+ * must not fail the upload: a retry would only store a duplicate.
+ * @param {Object} blob - GCS file instance
+ * @param {number} uploadedAtMs - Upload time the signature's expiry counts from
+ * @returns {Promise<string>} A V4 signed URL, or the plain URL as a fallback
+ */
+async function readableUrl(blob, uploadedAtMs) {
+  try {
+    // No request with a key file; under ADC this calls IAM signBlob,
+    // which needs iam.serviceAccounts.signBlob
+    const [url] = await blob.getSignedUrl({
+      version: 'v4',
+      action: 'read',
+      expires: uploadedAtMs + SIGNED_URL_TTL_MS
+    });
+    return url;
+  } catch (error) {
+    console.warn(`Could not sign URL for ${blob.name}, making it public: ${error.message}`);
+  }
+
+  try {
+    await blob.makePublic();
+  } catch (error) {
+    console.error(`Could not make ${blob.name} public:`, error.message);
+  }
+  return publicUrl(blob);
+}
+
+/**
+ * Upload a file in a single request
+ * @param {Object} blob - GCS file instance to write
+ * @param {Object} file - File object from multer
+ * @param {string} uploadedAt - ISO upload time stored as metadata
+ * @returns {Promise<void>} Resolves once GCS has the whole file
+ */
+function uploadAsStream(blob, file, uploadedAt) {
+  const blobStream = blob.createWriteStream({
+    resumable: false,
+    metadata: {
+      contentType: file.mimetype,
       metadata: {
-        contentType: file.mimetype,
-        metadata: {
-          originalName: file.originalname,
-          uploadedAt: new Date().toISOString()
-        }
+        originalName: file.originalname,
+        uploadedAt: uploadedAt
       }
-    });
+    }
+  });
 
-    return new Promise((resolve, reject) => {
-      blobStream.on('error', (err) => {
-        console.error('Upload error:', err);
-        reject(err);
-      });
+  return new Promise((resolve, reject) => {
+    blobStream.on('error', (err) => {
+      console.error('Upload error:', err);
+      reject(err);
+    });
 
-      blobStream.on('finish', async () => {
-        try {
-          // Make the file public (optional - remove if you want private files)
-          await blob.makePublic();
-
-          const publicUrl = `https://storage.googleapis.com/${bucket.name}/${blob.name}`;
-          
-          resolve({
-            filename: blob.name,
-            url: publicUrl,
-            size: file.size,
-            mimetype: file.mimetype,
-            uploadedAt: new Date().toISOString()
-          });
-        } catch (err) {
-          reject(err);
-        }
-      });
+    blobStream.on('finish', resolve);
 
+    // Stream from multer's temp file; memory storage hands us a buffer
+    if (file.path) {
+      fs.createReadStream(file.path)
+        .on('error', reject)
+        .pipe(blobStream);
+    } else {
       blobStream.end(file.buffer);
+    }
+  });
+}
+
+/**
+ * Upload a large file from disk as concurrent chunks
+ * @param {Object} bucket - GCS bucket instance
+ * @param {Object} file - File object from multer disk storage
+ * @param {string} destinationPath - Destination path in GCS
+ * @param {string} uploadedAt - ISO upload time stored as metadata
+ * @returns {Promise<void>} Resolves once all chunks are assembled
+ */
+async function uploadInChunks(bucket, file, destinationPath, uploadedAt) {
+  const transferManager = new TransferManager(bucket);
+
+  await chunkedUploadSlots.acquire();
+  try {
+    await transferManager.uploadFileInChunks(file.path, {
+      uploadName: destinationPath,
+      chunkSizeBytes: CHUNK_SIZE,
+      concurrencyLimit: CHUNK_CONCURRENCY,
+      headers: {
+        'Content-Type': file.mimetype,
+        'x-goog-meta-originalName': file.originalname,
+        'x-goog-meta-uploadedAt': uploadedAt
+      }
     });
-  } catch (error) {
-    console.error('GCS upload failed:', error);
-    throw error;
+  } finally {
+    chunkedUploadSlots.release();
   }
 }
 
@@ -1,22 +1,31 @@
 const express = require('express');
 const multer = require('multer');
+const fs = require('fs');
+const os = require('os');
 const { uploadToGCS } = require('../config/gcs');
 
 const router = express.Router();
 
-// Configure multer for memory storage (files will be uploaded to GCS from memory)
-const storage = multer.memoryStorage();
+// Configure multer for disk storage (files are spooled to a temp file and
+// streamed to GCS from there, so a large video never sits in memory)
+const storage = multer.diskStorage({
+  destination: os.tmpdir()
+});
 
-// File filter function
-const fileFilter = (req, file, cb) => {
-  const allowedMimeTypes = process.env.ALLOWED_MIME_TYPES 
+// Allowed types are fixed for the life of the process, so parse them once
+const allowedMimeTypes = new Set(
+  process.env.ALLOWED_MIME_TYPES
     ? process.env.ALLOWED_MIME_TYPES.split(',')
-    : ['video/mp4', 'video/webm', 'image/jpeg', 'image/png', 'image/jpg'];
+    : ['video/mp4', 'video/webm', 'image/jpeg', 'image/png', 'image/jpg']
+);
+const invalidTypeMessage = `Invalid file type. Allowed types: ${[...allowedMimeTypes].join(', ')}`;
 
-  if (allowedMimeTypes.includes(file.mimetype)) {
+// File filter function
+const fileFilter = (req, file, cb) => {
+  if (allowedMimeTypes.has(file.mimetype)) {
     cb(null, true);
   } else {
-    cb(new Error(`Invalid file type. Allowed types: ${allowedMimeTypes.join(', ')}`), false);
+    cb(new Error(invalidTypeMessage), false);
   }
 };
 
@@ -60,7 +69,7 @@ router.post('/', upload.single('recording'), async (req, res) => {
 
     // Upload to GCS
     console.log(`Uploading ${req.file.originalname} (${req.file.size} bytes) to GCS...`);
-    const uploadResult = await uploadToGCS(bucket, req.file, destinationPath);
+    const uploadResult = await uploadToGCS(bucket, req.file, destinationPath, timestamp);
 
     // Return success response
     res.status(201).json({
@@ -99,6 +108,13 @@ router.post('/', upload.single('recording'), async (req, res) => {
       error: 'Failed to upload file',
       details: error.message
     });
+  } finally {
+    // Remove the temp file whether or not the upload succeeded
+    if (req.file && req.file.path) {
+      fs.promises.unlink(req.file.path).catch((err) => {
+        console.error('Failed to remove temp file:', err);
+      });
+    }
   }
 });
 
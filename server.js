@@ -9,7 +9,8 @@ const app = express();
 const PORT = process.env.PORT || 3000;
 
 // Middleware
-app.use(cors());
+// Cache preflights for a day so each upload doesn't need an OPTIONS round trip
+app.use(cors({ maxAge: 86400 }));
 app.use(express.json());
 app.use(express.urlencoded({ extended: true }));
 
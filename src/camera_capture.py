@@ -1,21 +1,27 @@
 import cv2
 import time
 import multiprocessing as mp
-from queue import Full
 import logging
 import signal
 import os
 import numpy as np
 
 
+# Distinct noise frames the fake camera cycles through (power of two)
+FAKE_BACKGROUNDS = 8
+
+
 class CameraCapture:
-    def __init__(self, config, frame_queue, control_queue):
+    def __init__(self, config, frame_ring, control_queue):
         self.config = config
-        self.frame_queue = frame_queue
+        self.frame_ring = frame_ring
         self.control_queue = control_queue
         self.camera = None
         self.running = False
         self.use_fake_camera = os.getenv('RAILWAY_ENVIRONMENT_NAME') is not None
+        self._fake_backgrounds = None
+        self._fake_index = 0
+        self.dropped = 0
 
     def initialize_camera(self):
         """Initialize camera with retries"""
@@ -23,19 +29,25 @@ class CameraCapture:
             logging.info("Using fake camera (cloud environment detected)")
             return True
 
-        source = self.config['camera']['source']
+        # A GStreamer pipeline sets its own caps and can use hardware JPEG
+        # decoders; it needs an OpenCV build with GStreamer support
+        pipeline = self.config['camera'].get('pipeline')
+        source = pipeline or self.config['camera']['source']
         attempts = 0
         max_attempts = 5
 
         while attempts < max_attempts:
             try:
-                self.camera = cv2.VideoCapture(source)
+                if pipeline:
+                    self.camera = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+                else:
+                    self.camera = cv2.VideoCapture(source)
 
-                # Set camera properties
-                width, height = self.config['camera']['resolution']
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-                self.camera.set(cv2.CAP_PROP_FPS, self.config['camera']['fps'])
+                    # Set camera properties
+                    width, height = self.config['camera']['resolution']
+                    self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                    self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+                    self.camera.set(cv2.CAP_PROP_FPS, self.config['camera']['fps'])
 
                 if self.camera.isOpened():
                     logging.info(f"Camera initialized successfully: {source}")
@@ -49,14 +61,20 @@ class CameraCapture:
 
         return False
 
-    def generate_fake_frame(self):
-        """Generate a fake frame for testing"""
-        width, height = self.config['camera']['resolution']
-        frame = np.zeros((height, width, 3), dtype=np.uint8)
+    def generate_fake_frame(self, frame):
+        """Generate a fake frame for testing into the frame buffer"""
+        if self._fake_backgrounds is None:
+            # Random noise to make it look like a video stream, generated
+            # once; cycling a few frames keeps it moving without a fresh
+            # full-frame random fill every tick
+            width, height = self.config['camera']['resolution']
+            rng = np.random.default_rng()
+            self._fake_backgrounds = rng.integers(
+                0, 50, (FAKE_BACKGROUNDS, height, width, 3), dtype=np.uint8
+            )
         
-        # Add random noise to make it look like a video stream
-        noise = np.random.randint(0, 50, (height, width, 3), dtype=np.uint8)
-        frame = cv2.add(frame, noise)
+        np.copyto(frame, self._fake_backgrounds[self._fake_index])
+        self._fake_index = (self._fake_index + 1) & (FAKE_BACKGROUNDS - 1)
         
         # Add timestamp text
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
@@ -75,6 +93,11 @@ class CameraCapture:
 
         logging.info("Camera capture process started")
 
+        # Real cameras pace themselves: read() blocks until the driver has
+        # the next frame at CAP_PROP_FPS. Only the fake camera needs a clock.
+        frame_interval = 1.0 / self.config['camera']['fps']
+        next_frame = time.monotonic()
+
         while self.running:
             # Check for control commands
             if not self.control_queue.empty():
@@ -86,14 +109,38 @@ class CameraCapture:
                         self.camera.release()
                     self.initialize_camera()
 
-            # Capture frame
             if self.use_fake_camera:
-                frame = self.generate_fake_frame()
+                # Sleep to a fixed schedule so loop time doesn't add drift
+                next_frame += frame_interval
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind; carry on from now rather than bursting
+                    next_frame = time.monotonic()
+
+            # Every slot still being encoded, skip frame (backpressure)
+            slot = self.frame_ring.acquire()
+            if slot is None:
+                self.dropped += 1
+                if self.camera:
+                    # Consume the frame so the next read gets a fresh one
+                    self.camera.grab()
+                continue
+            buffer = self.frame_ring.frames[slot]
+
+            # Capture frame straight into the shared slot
+            if self.use_fake_camera:
+                frame = self.generate_fake_frame(buffer)
                 ret = True
             else:
-                ret, frame = self.camera.read()
+                ret, frame = self.camera.read(buffer)
+                if ret and frame is not buffer:
+                    # Camera didn't honour the configured resolution
+                    cv2.resize(frame, buffer.shape[1::-1], dst=buffer)
 
             if not ret:
+                self.frame_ring.release(slot)
                 logging.warning("Failed to capture frame, reconnecting...")
                 if self.camera:
                     self.camera.release()
@@ -102,36 +149,25 @@ class CameraCapture:
                     time.sleep(5)
                 continue
 
-            # Add timestamp and metadata
-            timestamp = time.time()
-            frame_data = {
-                'frame': frame,
-                'timestamp': timestamp,
-                'frame_number': frame_count,
-                'shape': frame.shape
-            }
-
-            # Put frame in queue (non-blocking)
-            try:
-                self.frame_queue.put(frame_data, block=False)
-                frame_count += 1
-            except Full:
-                # Queue full, skip frame (backpressure)
-                pass
-
-            # Maintain FPS
-            time.sleep(1.0 / self.config['camera']['fps'])
+            self.frame_ring.publish(slot, time.time(), frame_count)
+            frame_count += 1
 
         if self.camera:
             self.camera.release()
-        logging.info("Camera capture process stopped")
+        logging.info(f"Camera capture process stopped, dropped frames: {self.dropped}")
 
 
-def camera_process(config, frame_queue, control_queue):
+def camera_process(config, frame_ring, control_queue):
     """Entry point for camera capture process"""
     # Reset signal handlers to default for child process
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-    capture = CameraCapture(config, frame_queue, control_queue)
+    # Capture is cheap but must not be starved by the encoders
+    try:
+        os.nice(-5)
+    except (AttributeError, OSError):
+        logging.info("Could not raise camera process priority")
+
+    capture = CameraCapture(config, frame_ring, control_queue)
     capture.run()
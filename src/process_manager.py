@@ -1,9 +1,11 @@
 import multiprocessing as mp
 from multiprocessing import Queue
 import signal
+import threading
 import time
 import logging
 import os
+from src.shared_buffers import EncoderStats, FrameRing, LatestFrame
 from src.camera_capture import camera_process
 from src.stream_encoder import encoder_process
 from src.web_server import webserver_process
@@ -14,30 +16,81 @@ class ProcessManager:
         self.config = config
         self.processes = {}
         self.queues = {}
+        self.frame_ring = None
+        self.latest_frames = {}
+        self.encoder_stats = None
         self.running = False
+        self.stopped = threading.Event()
+        self.cpu_plan = {}
         
     def setup_queues(self):
         """Create communication queues"""
-        # Camera to encoder queue
-        self.queues['raw_frames'] = Queue(maxsize=self.config['processing']['buffer_size'])
-        
-        # Encoder to webserver queues (one per quality level)
-        self.queues['streams'] = {}
+        # Camera to encoder frames, passed by slot id through shared memory
+        width, height = self.config['camera']['resolution']
+        slots = self.config['processing'].get('frame_slots',
+                                              self.config['processing']['buffer_size'])
+        self.frame_ring = FrameRing(slots, (height, width, 3))
+        
+        # Encoder to webserver, latest frame only (one per quality level)
+        self.latest_frames = {}
         for format_config in self.config['streaming']['formats']:
             quality_name = format_config['name']
-            self.queues['streams'][quality_name] = Queue(maxsize=5)
+            max_bytes = format_config.get(
+                'max_bytes', format_config['width'] * format_config['height'] // 2
+            )
+            self.latest_frames[quality_name] = LatestFrame(max_bytes)
+        
+        # Encoder timings and drop counts, reported by the web server
+        self.encoder_stats = EncoderStats(
+            self.config['processing']['encoder_workers'],
+            [f['name'] for f in self.config['streaming']['formats']]
+        )
         
         # Control queues
         self.queues['camera_control'] = Queue()
         
+    def plan_cpu_affinity(self):
+        """Give the camera one core and split the rest between encoders
+
+        Keeps the encoders from competing for cores with each other and
+        with capture. Skipped when the platform can't pin processes or
+        there are too few cores to give every process its own.
+        """
+        if not self.config['processing'].get('cpu_affinity', True):
+            return {}
+        if not hasattr(os, 'sched_getaffinity'):
+            return {}
+        
+        cores = sorted(os.sched_getaffinity(0))
+        num_encoders = self.config['processing']['encoder_workers']
+        if len(cores) < num_encoders + 1:
+            return {}
+        
+        plan = {'camera': {cores[0]}}
+        for i in range(num_encoders):
+            plan[f'encoder_{i}'] = set(cores[1 + i::num_encoders])
+        return plan
+    
+    def pin_process(self, name, process):
+        """Apply the planned CPU affinity to a started process"""
+        cores = self.cpu_plan.get(name)
+        if cores is None:
+            return
+        try:
+            os.sched_setaffinity(process.pid, cores)
+            logging.info(f"Pinned {name} to CPUs {sorted(cores)}")
+        except OSError as e:
+            logging.warning(f"Could not pin {name} to CPUs {sorted(cores)}: {e}")
+    
     def start_camera_process(self):
         """Start camera capture process"""
         p = mp.Process(
             target=camera_process,
-            args=(self.config, self.queues['raw_frames'], self.queues['camera_control']),
+            args=(self.config, self.frame_ring, self.queues['camera_control']),
             name='CameraCapture'
         )
         p.start()
+        self.pin_process('camera', p)
         self.processes['camera'] = p
         logging.info("Camera process started")
     
@@ -48,11 +101,12 @@ class ProcessManager:
         for i in range(num_encoders):
             p = mp.Process(
                 target=encoder_process,
-                args=(self.config, self.queues['raw_frames'], 
-                      self.queues['streams'], i),
+                args=(self.config, self.frame_ring, 
+                      self.latest_frames, self.encoder_stats, i),
                 name=f'Encoder-{i}'
             )
             p.start()
+            self.pin_process(f'encoder_{i}', p)
             self.processes[f'encoder_{i}'] = p
             logging.info(f"Encoder {i} process started")
     
@@ -60,7 +114,7 @@ class ProcessManager:
         """Start web server process"""
         p = mp.Process(
             target=webserver_process,
-            args=(self.config, self.queues['streams']),
+            args=(self.config, self.latest_frames, self.encoder_stats),
             name='WebServer'
         )
         p.start()
@@ -70,6 +124,7 @@ class ProcessManager:
     def start_all(self):
         """Start all processes"""
         self.running = True
+        self.stopped.clear()
         
         # Ensure directories exist
         os.makedirs('logs', exist_ok=True)
@@ -80,6 +135,7 @@ class ProcessManager:
         
         # Setup queues
         self.setup_queues()
+        self.cpu_plan = self.plan_cpu_affinity()
         
         # Setup signal handlers (only in parent process)
         signal.signal(signal.SIGINT, self.handle_signal)
@@ -108,6 +164,7 @@ class ProcessManager:
     def stop_all(self):
         """Stop all processes gracefully"""
         self.running = False
+        self.stopped.set()
         logging.info("Stopping all processes...")
         
         # Signal camera to stop
@@ -126,19 +183,28 @@ class ProcessManager:
                 logging.warning(f"{name} didn't stop, killing...")
                 process.kill()
         
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring.unlink()
+            self.frame_ring = None
+        for latest in self.latest_frames.values():
+            latest.close()
+            latest.unlink()
+        self.latest_frames = {}
+        
         logging.info("All processes stopped")
     
     def monitor_health(self):
         """Monitor process health"""
         health_check_interval = self.config.get('monitoring', {}).get('health_check_interval', 5)
         
-        while self.running:
+        # Waiting on the event rather than sleeping lets stop_all() end the
+        # loop straight away
+        while not self.stopped.wait(health_check_interval):
             for name, process in list(self.processes.items()):
                 if not process.is_alive():
                     logging.error(f"Process {name} died unexpectedly")
                     # Could implement restart logic here
-            
-            time.sleep(health_check_interval)
     
     def handle_signal(self, signum, frame):
         """Handle shutdown signals"""
@@ -0,0 +1,282 @@
+from multiprocessing import Lock, Queue, RawArray, RawValue, reduction
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+from typing import NamedTuple
+import os
+import sys
+import threading
+import numpy as np
+
+
+# Written to a LatestFrame's wakeup fd per frame; eventfd needs a native
+# 8-byte count, and a pipe takes any bytes
+WAKEUP = (1).to_bytes(8, sys.byteorder)
+
+
+# Per-slot metadata, stored column-wise next to the pixel slab
+FRAME_META_DTYPE = np.dtype([('ts', 'f8'), ('fn', 'i8')])
+
+
+class RingFrame(NamedTuple):
+    """A filled ring slot as seen by an encoder"""
+    slot: int
+    frame: np.ndarray       # view into the ring, valid until released
+    timestamp: float
+    frame_number: int
+
+
+class FrameRing:
+    """Fixed ring of raw frame slots in shared memory
+
+    Frames are written straight into a slot by the camera and read in place
+    by the encoders, so only the slot id crosses a process boundary. A slot
+    moves from the free queue to the ready queue when the camera fills it,
+    and back to the free queue once an encoder has finished with it.
+    """
+
+    def __init__(self, slots, shape):
+        self.slots = slots
+        self.shape = tuple(shape)
+        frame_bytes = int(np.prod(self.shape))
+        self._frames_shm = SharedMemory(create=True, size=slots * frame_bytes)
+        self._meta_shm = SharedMemory(create=True, size=slots * FRAME_META_DTYPE.itemsize)
+        self.free = Queue(maxsize=slots)
+        self.ready = Queue(maxsize=slots)
+        for slot in range(slots):
+            self.free.put(slot)
+        self._map()
+
+    def _map(self):
+        """Build the numpy views over the shared segments"""
+        self.frames = np.ndarray((self.slots,) + self.shape, dtype=np.uint8,
+                                 buffer=self._frames_shm.buf)
+        meta = np.ndarray(self.slots, dtype=FRAME_META_DTYPE, buffer=self._meta_shm.buf)
+        self.timestamps = meta['ts']
+        self.frame_numbers = meta['fn']
+
+    def __getstate__(self):
+        # Views can't be pickled without copying the pixels; spawned
+        # processes attach to the segments by name instead
+        state = self.__dict__.copy()
+        for view in ('frames', 'timestamps', 'frame_numbers'):
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def acquire(self):
+        """Take a free slot id for writing, or None if all are in use"""
+        try:
+            return self.free.get_nowait()
+        except Empty:
+            return None
+
+    def publish(self, slot, timestamp, frame_number):
+        """Hand a filled slot to the encoders"""
+        self.timestamps[slot] = timestamp
+        self.frame_numbers[slot] = frame_number
+        self.ready.put_nowait(slot)
+
+    def take(self, timeout=None):
+        """Wait for the next filled slot; raises queue.Empty on timeout"""
+        slot = self.ready.get(timeout=timeout)
+        return RingFrame(slot, self.frames[slot],
+                         float(self.timestamps[slot]),
+                         int(self.frame_numbers[slot]))
+
+    def release(self, slot):
+        """Return a slot to the camera once nothing reads it any more"""
+        self.free.put_nowait(slot)
+
+    def release_after(self, slot, jobs):
+        """Release slot once every future in jobs has finished"""
+        if not jobs:
+            self.release(slot)
+            return
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+
+        def job_done(_job):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.release(slot)
+
+        for job in jobs:
+            job.add_done_callback(job_done)
+
+    def close(self):
+        """Drop this process's mapping of the segments"""
+        self.frames = self.timestamps = self.frame_numbers = None
+        self._frames_shm.close()
+        self._meta_shm.close()
+
+    def unlink(self):
+        """Free the segments; call once, from the process that created them"""
+        self._frames_shm.unlink()
+        self._meta_shm.unlink()
+
+
+class LatestFrame:
+    """Most recent encoded frame of one stream, double-buffered in shared memory
+
+    Viewers only ever want the newest frame, so there is no queue: a writer
+    fills the buffer readers aren't on and then bumps the sequence number,
+    and older frames are simply overwritten. Readers copy the current buffer
+    and retry if a writer started reusing it in the meantime.
+
+    Every write also signals an eventfd (a pipe where eventfd is missing,
+    e.g. macOS), so a reader can sleep in select() on the object itself
+    instead of polling seq.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._shm = SharedMemory(create=True, size=2 * max_bytes)
+        self._lengths = RawArray('Q', 2)
+        self._seq = RawValue('Q', 0)        # last completed write
+        self._writing = RawValue('Q', 0)    # last started write
+        self._frame_number = RawValue('q', -1)
+        self._write_lock = Lock()
+        if hasattr(os, 'eventfd'):
+            self._wakeup = self._wakeup_write = os.eventfd(
+                0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._wakeup, self._wakeup_write = os.pipe()
+            os.set_blocking(self._wakeup, False)
+            os.set_blocking(self._wakeup_write, False)
+
+    def __getstate__(self):
+        # The fd numbers alone are meaningless in a spawned process
+        state = self.__dict__.copy()
+        state['_wakeup'] = reduction.DupFd(self._wakeup)
+        state['_wakeup_write'] = (None if self._wakeup_write == self._wakeup
+                                  else reduction.DupFd(self._wakeup_write))
+        return state
+
+    def __setstate__(self, state):
+        state['_wakeup'] = state['_wakeup'].detach()
+        if state['_wakeup_write'] is None:
+            state['_wakeup_write'] = state['_wakeup']
+        else:
+            state['_wakeup_write'] = state['_wakeup_write'].detach()
+        self.__dict__.update(state)
+
+    def fileno(self):
+        """Readable whenever a frame has been written since clear_wakeup()"""
+        return self._wakeup
+
+    def clear_wakeup(self):
+        """Reset the readiness reported through fileno()"""
+        try:
+            # One read resets an eventfd; a pipe may hold several wakeups
+            while os.read(self._wakeup, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    @property
+    def seq(self):
+        """Sequence number of the latest frame, 0 before the first"""
+        return self._seq.value
+
+    def write(self, data, frame_number):
+        """Publish data as the latest frame
+
+        Returns False without writing if a newer frame has already been
+        published, which happens when several encoders finish out of order.
+        """
+        length = len(data)
+        if length > self.max_bytes:
+            raise ValueError(f"frame of {length} bytes exceeds slot size {self.max_bytes}")
+        with self._write_lock:
+            if frame_number <= self._frame_number.value:
+                return False
+            self._frame_number.value = frame_number
+            seq = self._seq.value + 1
+            self._writing.value = seq
+            index = seq & 1
+            offset = index * self.max_bytes
+            self._shm.buf[offset:offset + length] = data
+            self._lengths[index] = length
+            self._seq.value = seq
+        try:
+            os.write(self._wakeup_write, WAKEUP)
+        except BlockingIOError:
+            pass  # Pipe full: the reader has wakeups pending already
+        return True
+
+    def read(self):
+        """Return (seq, data) for the latest frame, or (0, None) before the first"""
+        while True:
+            seq = self._seq.value
+            if seq == 0:
+                return 0, None
+            index = seq & 1
+            offset = index * self.max_bytes
+            data = bytes(self._shm.buf[offset:offset + self._lengths[index]])
+            # A write two ahead reuses the buffer just copied
+            if self._writing.value < seq + 2:
+                return seq, data
+
+    def close(self):
+        """Drop this process's mapping of the segment"""
+        os.close(self._wakeup)
+        if self._wakeup_write != self._wakeup:
+            os.close(self._wakeup_write)
+        self._shm.close()
+
+    def unlink(self):
+        """Free the segment; call once, from the process that created it"""
+        self._shm.unlink()
+
+
+class EncoderStats:
+    """Per-encoder, per-format counters shared with the web server
+
+    Each encoder writes only its own rows, so no lock is shared between
+    processes. Within an encoder, dropped (formats busy at dispatch) is
+    written only by the dispatch thread, while stale (superseded on
+    publish) and the encode counters are written by pool threads, which
+    must serialize those updates themselves. Readers may see a row
+    mid-update, which is fine for monitoring.
+    """
+
+    # Weight of the newest sample in the encode time average
+    EMA_ALPHA = 0.1
+
+    def __init__(self, encoders, formats):
+        self.encoders = encoders
+        self.formats = list(formats)
+        size = encoders * len(self.formats)
+        self.encoded = RawArray('Q', size)
+        self.dropped = RawArray('Q', size)
+        self.stale = RawArray('Q', size)
+        self.encode_ms = RawArray('d', size)
+
+    def index(self, encoder_id, name):
+        """Position of an encoder's counters for a format"""
+        return encoder_id * len(self.formats) + self.formats.index(name)
+
+    def record_encode(self, index, seconds):
+        """Count a finished encode and fold its time into the average"""
+        ms = seconds * 1000.0
+        average = self.encode_ms[index]
+        self.encode_ms[index] = ms if average == 0.0 else average + self.EMA_ALPHA * (ms - average)
+        self.encoded[index] += 1
+
+    def snapshot(self):
+        """Totals per format across encoders; dropped includes stale"""
+        totals = {}
+        for name in self.formats:
+            rows = [self.index(i, name) for i in range(self.encoders)]
+            times = [self.encode_ms[i] for i in rows if self.encode_ms[i]]
+            totals[name] = {
+                'encoded': sum(self.encoded[i] for i in rows),
+                'dropped': sum(self.dropped[i] + self.stale[i] for i in rows),
+                'encode_ms': sum(times) / len(times) if times else 0.0
+            }
+        return totals
@@ -1,33 +1,304 @@
 import cv2
 import time
+import threading
 import multiprocessing as mp
-from queue import Empty, Full
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Empty
 import logging
 import signal
 
+try:
+    from nvjpeg import NvJpeg
+except ImportError:
+    NvJpeg = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
+
 
 class StreamEncoder:
-    def __init__(self, config, input_queue, output_queues, encoder_id):
+    def __init__(self, config, frame_ring, latest_frames, stats, encoder_id):
         self.config = config
-        self.input_queue = input_queue
-        self.output_queues = output_queues  # Dict of quality -> queue
+        self.frame_ring = frame_ring
+        self.latest_frames = latest_frames  # Dict of quality -> LatestFrame
+        self.stats = stats
         self.encoder_id = encoder_id
         self.running = False
-        
-    def encode_frame(self, frame, quality_config):
-        """Encode frame to JPEG with specific quality settings"""
-        # Resize if needed
+        self._local = threading.local()
+        self._tj = None
+        self.jpeg_backend = self.select_jpeg_backend(
+            config['processing'].get('jpeg_backend', 'auto')
+        )
+        self.scaled_formats = self.plan_scaled_formats()
+        self._pool = ThreadPoolExecutor(
+            # A derived format can have a recompress waiting on its source
+            # and a pixel encode running at once
+            max_workers=len(config['streaming']['formats']) + len(self.scaled_formats),
+            thread_name_prefix=f'Encoder-{encoder_id}'
+        )
+        # Formats encoded from pixels are dispatched first so derived ones
+        # always find their source's job for the same frame
+        self._dispatch_order = sorted(
+            config['streaming']['formats'],
+            key=lambda f: f['name'] in self.scaled_formats
+        )
+        self._in_flight = {}
+        self._scaling = {}     # derived format -> its latest recompress job
+        # Pool threads share stats rows (a derived format can finish two
+        # jobs at once); the dispatch thread's dropped column needs none
+        self._stats_lock = threading.Lock()
+        self._stat_index = {
+            f['name']: stats.index(encoder_id, f['name'])
+            for f in config['streaming']['formats']
+        }
+        # Checked here rather than at import so the CUDA/OpenCL runtimes are
+        # set up inside the encoder process, not inherited across fork
+        self.use_cuda = hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+        self.use_opencl = not self.use_cuda and cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+        if self.use_cuda:
+            logging.info(f"Encoder {self.encoder_id}: resizing with CUDA")
+        elif self.use_opencl:
+            logging.info(f"Encoder {self.encoder_id}: resizing with OpenCL")
+        # Ring slots all have the camera's shape, so each format's resize and
+        # encode settings are fixed for the life of the process. Derived
+        # formats get one too, for frames their source had to skip.
+        self._encoders = {
+            f['name']: self.make_encoder(frame_ring.shape, f)
+            for f in config['streaming']['formats']
+        }
+
+    def select_jpeg_backend(self, requested):
+        """Pick the JPEG encoder backend, falling back to OpenCV"""
+        if requested in ('auto', 'nvjpeg'):
+            if NvJpeg is not None:
+                try:
+                    self._nvjpeg()
+                    logging.info(f"Encoder {self.encoder_id}: using nvJPEG (GPU) encoder")
+                    return 'nvjpeg'
+                except Exception as e:
+                    logging.warning(f"Encoder {self.encoder_id}: nvJPEG unavailable: {e}")
+            elif requested == 'nvjpeg':
+                logging.warning(f"Encoder {self.encoder_id}: nvjpeg package not installed")
+
+        if requested in ('auto', 'turbojpeg'):
+            if TurboJPEG is not None:
+                try:
+                    # Loads libjpeg-turbo once; encode() is safe to call
+                    # from several threads on the same instance
+                    self._tj = TurboJPEG()
+                    logging.info(f"Encoder {self.encoder_id}: using TurboJPEG encoder")
+                    return 'turbojpeg'
+                except Exception as e:
+                    logging.warning(f"Encoder {self.encoder_id}: libjpeg-turbo unavailable: {e}")
+            elif requested == 'turbojpeg':
+                logging.warning(f"Encoder {self.encoder_id}: PyTurboJPEG package not installed")
+
+        return 'opencv'
+
+    def plan_scaled_formats(self):
+        """Find formats that can be derived from a larger format's JPEG
+
+        libjpeg-turbo can decode at n/8 scale factors straight from the DCT
+        coefficients. A format whose size is an exact scaled copy of a larger
+        format is recompressed from that JPEG instead of resized and encoded
+        from pixels. Returns {name: (source_name, scaling_factor)}.
+
+        Only formats that would otherwise need a resize are derived, and
+        only from sources no larger than the camera frame: a format at the
+        camera's own size is cheapest encoded directly, and an upscaled
+        source would cost more than it saves and lose detail on the way.
+        """
+        if self.jpeg_backend != 'turbojpeg':
+            return {}
+
+        frame_height, frame_width = self.frame_ring.shape[:2]
+        # Largest first, so every candidate source is settled before use
+        formats = sorted(
+            (f for f in self.config['streaming']['formats']
+             if f['width'] <= frame_width and f['height'] <= frame_height),
+            key=lambda f: f['width'] * f['height'], reverse=True
+        )
+        factors = sorted(f for f in self._tj.scaling_factors if f[0] < f[1])
+        plan = {}
+        for i, target in enumerate(formats):
+            if target['width'] == frame_width and target['height'] == frame_height:
+                continue
+            for source in formats[:i]:
+                if source['name'] in plan:
+                    continue
+                for num, denom in factors:
+                    if (-(-source['width'] * num // denom) == target['width'] and
+                            -(-source['height'] * num // denom) == target['height']):
+                        plan[target['name']] = (source['name'], (num, denom))
+                        break
+                if target['name'] in plan:
+                    break
+
+        for name, (source_name, (num, denom)) in plan.items():
+            logging.info(f"Encoder {self.encoder_id}: deriving {name} from {source_name} at {num}/{denom} scale")
+        return plan
+
+    def plan_resize(self, frame_shape, quality_config):
+        """Return (size, interpolation) to resize a frame for a format, or None"""
         target_size = (quality_config['width'], quality_config['height'])
-        if frame.shape[1] != target_size[0] or frame.shape[0] != target_size[1]:
-            resized = cv2.resize(frame, target_size)
+        if frame_shape[1] == target_size[0] and frame_shape[0] == target_size[1]:
+            return None
+        # INTER_AREA is sharper for downscales and a cheap box filter
+        if target_size[0] < frame_shape[1]:
+            return target_size, cv2.INTER_AREA
+        return target_size, cv2.INTER_LINEAR
+
+    def dispatch_frame(self, frame_data):
+        """Start encoding frame_data for every format that is free
+
+        Each format runs on its own pool thread; OpenCV, libjpeg-turbo and
+        nvJPEG release the GIL while encoding. A format still busy with an
+        earlier frame drops this one instead of queueing behind it, so a slow
+        format (usually UHD) loses frames rather than falling further behind
+        the camera. A derived format is recompressed from its source's JPEG
+        when the source takes the frame; when the source skips it, the
+        format is encoded from pixels like any other, so it never inherits
+        the source's drops. Finished jobs publish their own output, and the frame's ring slot is
+        handed back to the camera once all of them are done.
+        """
+        started = {}
+        for format_config in self._dispatch_order:
+            quality_name = format_config['name']
+            job = None
+            if quality_name in self.scaled_formats:
+                job = self._start_scaled(quality_name, format_config, started)
+
+            if job is None:
+                pending = self._in_flight.get(quality_name)
+                if pending is not None and not pending.done():
+                    self.stats.dropped[self._stat_index[quality_name]] += 1
+                    continue
+                job = self._in_flight[quality_name] = self._pool.submit(
+                    self._timed, quality_name,
+                    self._encoders[quality_name], frame_data.frame
+                )
+
+            job.add_done_callback(partial(self.publish_frame, quality_name, frame_data))
+            started[quality_name] = job
+
+        self.frame_ring.release_after(frame_data.slot, list(started.values()))
+
+    def _start_scaled(self, quality_name, format_config, started):
+        """Submit a derived format's recompress from this frame's source job
+
+        Returns None when the source skipped the frame or the previous
+        recompress is still running.
+        """
+        source_name, factor = self.scaled_formats[quality_name]
+        source = started.get(source_name)
+        pending = self._scaling.get(quality_name)
+        if source is None or (pending is not None and not pending.done()):
+            return None
+        job = self._scaling[quality_name] = self._pool.submit(
+            self._scale_encoded, quality_name,
+            source, factor, format_config['quality']
+        )
+        return job
+
+    def _timed(self, quality_name, encode, *args, **kwargs):
+        """Run an encode job and record how long it took"""
+        start = time.perf_counter()
+        encoded = encode(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.stats.record_encode(self._stat_index[quality_name], elapsed)
+        return encoded
+
+    def _scale_encoded(self, quality_name, source_future, factor, quality):
+        """Recompress another format's JPEG at a libjpeg-turbo scale factor
+
+        Only the recompression is timed, not the wait for the source.
+        """
+        source = source_future.result()
+        return self._timed(
+            quality_name, self._tj.scale_with_quality,
+            source, scaling_factor=factor, quality=quality
+        )
+
+    def _nvjpeg(self):
+        """Return this thread's nvJPEG handle, creating it on first use"""
+        encoder = getattr(self._local, 'nvjpeg', None)
+        if encoder is None:
+            encoder = self._local.nvjpeg = NvJpeg()
+        return encoder
+
+    def make_encoder(self, frame_shape, quality_config):
+        """Build the resize-and-encode function for one format
+
+        Everything that depends only on the format is resolved here, so the
+        returned function does no per-frame config lookups or branching.
+        """
+        quality = quality_config['quality']
+        resize_plan = self.plan_resize(frame_shape, quality_config)
+
+        if resize_plan is None:
+            def resize(frame):
+                return frame
         else:
-            resized = frame
-        
-        # Encode to JPEG
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality_config['quality']]
-        _, encoded = cv2.imencode('.jpg', resized, encode_param)
+            target_size, interpolation = resize_plan
+            if self.use_cuda:
+                def resize(frame):
+                    return cv2.cuda.resize(cv2.cuda_GpuMat(frame), target_size,
+                                           interpolation=interpolation).download()
+            elif self.use_opencl:
+                def resize(frame):
+                    return cv2.resize(cv2.UMat(frame), target_size,
+                                      interpolation=interpolation).get()
+            else:
+                def resize(frame):
+                    return cv2.resize(frame, target_size, interpolation=interpolation)
+
+        # All backends scale the standard Annex K quantization tables with
+        # the IJG quality formula, so a given quality produces the same
+        # tables (and comparable output) on any backend.
+        if self.jpeg_backend == 'nvjpeg':
+            nvjpeg = self._nvjpeg
+
+            def encode(frame):
+                return nvjpeg().encode(resize(frame), quality)
+        elif self.jpeg_backend == 'turbojpeg':
+            tj_encode = self._tj.encode
+
+            def encode(frame):
+                return tj_encode(resize(frame), quality=quality,
+                                 pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+        else:
+            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+            def encode(frame):
+                _, encoded = cv2.imencode('.jpg', resize(frame), encode_param)
+                return encoded.tobytes()
+
+        return encode
+    
+    def publish_frame(self, quality_name, frame_data, job):
+        """Publish a finished encode as its quality's latest frame"""
+        try:
+            encoded_frame = job.result()
+        except Exception as e:
+            logging.error(f"Encoder {self.encoder_id}: Error encoding {quality_name} frame: {e}")
+            return
         
-        return encoded.tobytes()
+        # Replace the quality's latest frame; a frame another encoder has
+        # already superseded is dropped
+        if quality_name in self.latest_frames:
+            try:
+                if not self.latest_frames[quality_name].write(
+                    encoded_frame,
+                    frame_data.frame_number
+                ):
+                    with self._stats_lock:
+                        self.stats.stale[self._stat_index[quality_name]] += 1
+            except Exception as e:
+                logging.error(f"Encoder {self.encoder_id}: Error publishing {quality_name} frame: {e}")
     
     def run(self):
         """Main encoding loop"""
@@ -36,53 +307,32 @@ class StreamEncoder:
         
         while self.running:
             try:
-                # Get frame from input queue
-                frame_data = self.input_queue.get(timeout=1.0)
+                # Get the next filled slot; the pixels stay in shared memory
+                frame_data = self.frame_ring.take(timeout=1.0)
                 
                 # Encode for each quality level
-                for format_config in self.config['streaming']['formats']:
-                    quality_name = format_config['name']
-                    
-                    # Encode frame
-                    encoded_frame = self.encode_frame(
-                        frame_data['frame'], 
-                        format_config
-                    )
-                    
-                    # Package with metadata
-                    output_data = {
-                        'data': encoded_frame,
-                        'timestamp': frame_data['timestamp'],
-                        'frame_number': frame_data['frame_number'],
-                        'quality': quality_name
-                    }
-                    
-                    # Send to appropriate output queue
-                    if quality_name in self.output_queues:
-                        try:
-                            self.output_queues[quality_name].put(
-                                output_data, 
-                                block=False
-                            )
-                        except Full:
-                            # Queue full, skip frame (backpressure handling)
-                            pass
-                        except Exception as e:
-                            logging.error(f"Encoder {self.encoder_id}: Error putting frame to {quality_name} queue: {e}")
+                self.dispatch_frame(frame_data)
                 
             except Empty:
                 continue
             except Exception as e:
                 logging.error(f"Encoder {self.encoder_id} error: {e}")
         
-        logging.info(f"Encoder {self.encoder_id} stopped")
+        self._pool.shutdown()
+        dropped = {name: self.stats.dropped[i] + self.stats.stale[i]
+                   for name, i in self._stat_index.items()}
+        logging.info(f"Encoder {self.encoder_id} stopped, dropped frames: {dropped}")
 
 
-def encoder_process(config, input_queue, output_queues, encoder_id):
+def encoder_process(config, frame_ring, latest_frames, stats, encoder_id):
     """Entry point for encoder process"""
     # Reset signal handlers to default for child process
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
     
-    encoder = StreamEncoder(config, input_queue, output_queues, encoder_id)
+    # Formats already run in parallel on the encoder's pool; OpenCV's own
+    # worker threads on top of that would oversubscribe the pinned cores
+    cv2.setNumThreads(1)
+    
+    encoder = StreamEncoder(config, frame_ring, latest_frames, stats, encoder_id)
     encoder.run()
@@ -9,7 +9,15 @@ cap = cv2.VideoCapture(0)
 cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
 cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
 
-print(f"Uploading to {RAILWAY_URL}/upload/{QUALITY}")
+UPLOAD_URL = f"{RAILWAY_URL}/upload/{QUALITY}"
+
+# One keep-alive connection for the whole stream instead of a new TCP+TLS
+# handshake per frame
+session = requests.Session()
+session.headers['Content-Type'] = 'image/jpeg'
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+print(f"Uploading to {UPLOAD_URL}")
 
 while True:
     ret, frame = cap.read()
@@ -23,13 +31,9 @@ while True:
     
     # Upload to Railway
     try:
-        response = requests.post(
-            f"{RAILWAY_URL}/upload/{QUALITY}",
-            data=buffer.tobytes(),
-            headers={'Content-Type': 'image/jpeg'},
-            timeout=2
-        )
-        print(f"Uploaded: {response.status_code} - {response.json()}")
+        response = session.post(UPLOAD_URL, data=buffer.tobytes(), timeout=2)
+        if response.status_code != 200:
+            print(f"Upload rejected: {response.status_code} - {response.text}")
     except Exception as e:
         print(f"Upload error: {e}")
     
@@ -1,58 +1,289 @@
 from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import time
+import hashlib
 import io
-from collections import deque
-from threading import Lock
+import logging
+import selectors
+import signal
+import socket
+from threading import Condition, Lock, Thread
+
+try:
+    from gevent import monkey
+    from gevent.pywsgi import WSGIHandler, WSGIServer
+except ImportError:
+    WSGIServer = None
+else:
+    class SocketWSGIHandler(WSGIHandler):
+        """pywsgi handler that puts the client socket in the environ"""
+
+        def get_environ(self):
+            environ = super().get_environ()
+            environ['gevent.socket'] = self.socket
+            return environ
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_SORT_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 
-# Store frames in memory (last 30 frames per quality)
-frame_buffers = {
-    'hd': deque(maxlen=30),
-    'sd': deque(maxlen=30),
-    'uhd': deque(maxlen=30)
+# Latest frame per quality; viewers only ever send the newest one
+latest_frame = {
+    'hd': None,
+    'sd': None,
+    'uhd': None
 }
-buffer_lock = Lock()
+frame_seq = {quality: 0 for quality in latest_frame}
+# Largest frame /upload accepts; well above a q95 UHD JPEG, and checked
+# before the body buffer is sized from the client's Content-Length
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_FRAME_BYTES
+# Connected viewers per quality in this process, guarded by frame_ready
+viewers = {quality: 0 for quality in latest_frame}
+# Notified on every new frame, so viewers wake per frame instead of polling
+frame_ready = {quality: Condition() for quality in latest_frame}
+
+# Per-part header; Content-Length lets clients read each JPEG without
+# scanning it for the boundary
+PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+
+# Shared encoder counters, set when running under the process manager
+encoder_stats = None
+# Previous (time, snapshot) of encoder_stats, for per-second rates
+stats_sample = None
+# Serialized /api/stats body and when it was built; pollers within the TTL
+# share it, which also keeps the rate windows at least that long
+STATS_TTL = 1.0
+stats_cache = (0.0, None)
+stats_lock = Lock()
+
+
+def set_latest_frame(quality, frame):
+    """Swap in a new latest frame and wake the quality's viewers"""
+    with frame_ready[quality]:
+        latest_frame[quality] = frame
+        frame_seq[quality] += 1
+        frame_ready[quality].notify_all()
+        return frame_seq[quality]
+
+def read_frame_body():
+    """Read the request body into a buffer sized from Content-Length
+
+    Avoids request.data collecting the body in chunks and joining them.
+    The result is bytes since WSGI servers only accept bytes chunks, and
+    viewers send the frame straight from it.
+    """
+    length = request.content_length
+    if length is None:
+        return request.get_data()
+    
+    frame_data = bytearray(length)
+    view = memoryview(frame_data)
+    received = 0
+    while received < length:
+        n = request.stream.readinto(view[received:])
+        if not n:
+            return None  # Client went away mid-frame
+        received += n
+    return bytes(frame_data)
 
 @app.route('/upload/<quality>', methods=['POST'])
 def upload_frame(quality):
     """Receive frames from local camera"""
-    if quality not in frame_buffers:
+    if quality not in latest_frame:
         return jsonify({'error': 'Invalid quality'}), 400
     
-    frame_data = request.data
+    if (request.content_length or 0) > MAX_FRAME_BYTES:
+        return jsonify({'error': 'Frame too large'}), 413
+    
+    frame_data = read_frame_body()
     if not frame_data:
         return jsonify({'error': 'No frame data'}), 400
     
-    with buffer_lock:
-        frame_buffers[quality].append(frame_data)
+    seq = set_latest_frame(quality, frame_data)
     
-    return jsonify({'status': 'ok', 'buffer_size': len(frame_buffers[quality])}), 200
+    return jsonify({'status': 'ok', 'frame': seq}), 200
+
+def tune_stream_socket():
+    """Set up the client socket for a long-lived MJPEG stream
+
+    Each part is written as soon as its frame exists, so Nagle's algorithm
+    only delays it waiting on the previous part's ACK, and a larger send
+    buffer lets a whole UHD frame be queued without blocking.
+    """
+    # Werkzeug, gunicorn's sync/gevent workers, its gevent_pywsgi worker
+    # and our own pywsgi handler each use a different key
+    environ = request.environ
+    sock = (environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+            or environ.get('gunicorn.sock') or environ.get('gevent.socket'))
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    except OSError as e:
+        logging.debug(f"Could not tune stream socket: {e}")
 
 @app.route('/stream/<quality>')
 def stream(quality):
     """Serve the stream to viewers"""
-    if quality not in frame_buffers:
+    if quality not in latest_frame:
         return "Invalid quality", 404
     
+    ready = frame_ready[quality]
+    tune_stream_socket()
+    
     def generate():
-        while True:
-            with buffer_lock:
-                if frame_buffers[quality]:
-                    frame = frame_buffers[quality][-1]  # Get latest frame
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-            time.sleep(0.033)  # ~30fps
+        with ready:
+            viewers[quality] += 1
+        # Everything the loop touches per frame, looked up once per viewer
+        seqs, frames = frame_seq, latest_frame
+        wait_for = ready.wait_for
+        header, tail = PART_HEADER, b'\r\n'
+        last_seq = 0
+
+        def new_frame():
+            return seqs[quality] != last_seq
+
+        try:
+            while True:
+                with ready:
+                    wait_for(new_frame)
+                    last_seq = seqs[quality]
+                    frame = frames[quality]
+                # Separate chunks go to the socket as-is, so the JPEG is never
+                # copied into a combined part
+                yield header % len(frame)
+                yield frame
+                yield tail
+        finally:
+            # Runs when the server closes the generator on disconnect
+            with ready:
+                viewers[quality] -= 1
     
-    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # X-Accel-Buffering stops nginx-style proxies holding parts back
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-store, no-transform',
+                             'X-Accel-Buffering': 'no'},
+                    direct_passthrough=True)
 
-@app.route('/')
-def index():
-    return """
+def collect_stats(now):
+    """Frames and viewers per quality and, if known, encoder health"""
+    global stats_sample
+    streams = {
+        quality: {'frames': seq, 'viewers': viewers[quality]}
+        for quality, seq in frame_seq.items()
+    }
+    
+    if encoder_stats is not None:
+        snapshot = encoder_stats.snapshot()
+        previous = stats_sample
+        stats_sample = (now, snapshot)
+        
+        for quality, counters in snapshot.items():
+            entry = streams.setdefault(quality, {})
+            entry.update(counters)
+            if previous is not None and now > previous[0]:
+                elapsed = now - previous[0]
+                before = previous[1][quality]
+                entry['encoded_per_second'] = (counters['encoded'] - before['encoded']) / elapsed
+                entry['dropped_per_second'] = (counters['dropped'] - before['dropped']) / elapsed
+    
+    return {'streams': streams}
+
+@app.route('/api/stats')
+def api_stats():
+    """Report pipeline stats, rebuilt at most once per STATS_TTL"""
+    global stats_cache
+    now = time.monotonic()
+    with stats_lock:
+        built, body = stats_cache
+        if body is None or now - built >= STATS_TTL:
+            body = app.json.dumps(collect_stats(now)).encode('utf-8')
+            stats_cache = (now, body)
+    return Response(body, mimetype='application/json')
+
+# The ETag is a hash of the page, so it only changes when the page does
+INDEX_HTML = """
     <html>
     <body>
     <h1>24/7 Camera Stream</h1>
     <img src="/stream/hd" width="1280">
     </body>
     </html>
-    """
+    """.encode('utf-8')
+INDEX_ETAG = hashlib.sha256(INDEX_HTML).hexdigest()
+
+@app.route('/')
+def index():
+    response = Response(INDEX_HTML, mimetype='text/html',
+                        headers={'Cache-Control': 'public, max-age=300'})
+    response.set_etag(INDEX_ETAG)
+    return response.make_conditional(request)
+
+
+def pump_frames(quality, latest):
+    """Move new frames from an encoder's shared slot to the viewers"""
+    selector = selectors.DefaultSelector()
+    selector.register(latest, selectors.EVENT_READ)
+    last_seq = 0
+    while True:
+        if latest.seq == last_seq:
+            # Sleeps until an encoder writes; cleared before seq is checked
+            # again so a write in between still wakes the next select
+            selector.select()
+            latest.clear_wakeup()
+            continue
+        last_seq, frame = latest.read()
+        set_latest_frame(quality, frame)
+
+
+def webserver_process(config, latest_frames, stats):
+    """Entry point for web server process"""
+    global encoder_stats
+    # Reset signal handlers to default for child process
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    
+    encoder_stats = stats
+    
+    if WSGIServer is not None:
+        # One greenlet per viewer instead of an OS thread. Patched here so
+        # only the web server process goes cooperative; camera and encoders
+        # keep real threads.
+        monkey.patch_all()
+        # Conditions made at import would hand out the unpatched waiters
+        for quality in frame_ready:
+            frame_ready[quality] = Condition()
+    
+    for quality, latest in latest_frames.items():
+        if quality not in latest_frame:
+            logging.warning(f"Web server: no stream route for quality {quality}")
+            continue
+        Thread(target=pump_frames, args=(quality, latest),
+               name=f'Pump-{quality}', daemon=True).start()
+    
+    logging.info(f"Web server listening on port {config['streaming']['port']}")
+    if WSGIServer is not None:
+        WSGIServer((config['streaming']['host'], config['streaming']['port']), app,
+                   handler_class=SocketWSGIHandler, log=None).serve_forever()
+    else:
+        app.run(host=config['streaming']['host'], port=config['streaming']['port'],
+                threaded=True)
@@ -0,0 +1,50 @@
+from app import read_mjpeg
+
+
+class FakeResponse:
+    """Stands in for a streaming requests.Response"""
+
+    def __init__(self, body, content_type='multipart/x-mixed-replace; boundary=frame',
+                 chunk=7):
+        self.headers = {'Content-Type': content_type} if content_type else {}
+        self._body = body
+        self._chunk = chunk
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self._body), self._chunk):
+            yield self._body[i:i + self._chunk]
+
+
+def part(jpeg, length=False):
+    header = b'--frame\r\nContent-Type: image/jpeg\r\n'
+    if length:
+        header += b'Content-Length: %d\r\n' % len(jpeg)
+    return header + b'\r\n' + jpeg + b'\r\n'
+
+
+# Compressed data can contain the boundary token, and even "--frame"
+JPEGS = [b'\xff\xd8one frame here\xff\xd9', b'\xff\xd8two--frame\nmore\xff\xd9',
+         b'\xff\xd8three\xff\xd9']
+
+
+def test_parts_without_content_length_keep_boundary_token():
+    body = b''.join(part(j) for j in JPEGS) + b'--frame--\r\n'
+    assert list(read_mjpeg(FakeResponse(body))) == JPEGS
+
+
+def test_parts_with_content_length():
+    body = b''.join(part(j, length=True) for j in JPEGS)
+    assert list(read_mjpeg(FakeResponse(body))) == JPEGS
+
+
+def test_boundary_from_body_when_header_lacks_it():
+    body = b''.join(part(j) for j in JPEGS) + b'--frame--\r\n'
+    frames = read_mjpeg(FakeResponse(body, content_type='multipart/x-mixed-replace'))
+    assert list(frames) == JPEGS
+
+
+def test_boundary_with_leading_dashes():
+    body = (b'----BoundaryString\r\n\r\n' + JPEGS[1] + b'\r\n'
+            b'----BoundaryString\r\n\r\n' + JPEGS[2] + b'\r\n----BoundaryString--\r\n')
+    response = FakeResponse(body, content_type='multipart/x-mixed-replace;boundary=--BoundaryString')
+    assert list(read_mjpeg(response)) == JPEGS[1:]